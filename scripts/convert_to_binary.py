@@ -1,31 +1,86 @@
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import os
 import json
+import orjson
+import csv
+import argparse
 import struct
+from datetime import datetime, timezone
+from numba import njit, prange
 from tqdm import tqdm
 
+# 二进制输出文件的写缓冲区大小
+WRITE_BUFFER_SIZE = 1 << 20
+
+@njit(parallel=True, cache=True)
+def _extract_nonzero(matrix, cell_indices):
+    """按列提取非零值：先并行统计每列非零个数，再并行填充到扁平数组
+    
+    缺失值在读取时已是float32缓冲区中的NaN，这里直接用np.isnan过滤。
+    """
+    n_rows, n_features = matrix.shape
+    counts = np.zeros(n_features, dtype=np.int64)
+    for j in prange(n_features):
+        count = 0
+        for r in range(n_rows):
+            v = matrix[r, j]
+            if v != 0 and not np.isnan(v):
+                count += 1
+        counts[j] = count
+    
+    offsets = np.zeros(n_features + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    idx = np.empty(offsets[n_features], dtype=np.uint32)
+    val = np.empty(offsets[n_features], dtype=np.float32)
+    for j in prange(n_features):
+        k = offsets[j]
+        for r in range(n_rows):
+            v = matrix[r, j]
+            if v != 0 and not np.isnan(v):
+                idx[k] = cell_indices[r]
+                val[k] = v
+                k += 1
+    return idx, val, offsets
+
+@njit(parallel=True, cache=True)
+def _merge_batch(all_idx, all_val, cursor, idx, val, offsets):
+    """将单个数据块的提取结果按特征写入合并数组，cursor为各特征的当前写入位置"""
+    for j in prange(offsets.size - 1):
+        start = offsets[j]
+        n = offsets[j + 1] - start
+        pos = cursor[j]
+        all_idx[pos:pos + n] = idx[start:start + n]
+        all_val[pos:pos + n] = val[start:start + n]
+        cursor[j] = pos + n
+
 class BaseDataConverter:
-    def __init__(self, base_path='/home/ug1128u9/ST-RNA-ATAC_Palate/web/spatial-visualizer/public/data'):
+    def __init__(self, base_path='/home/ug1128u9/ST-RNA-ATAC_Palate/web/spatial-visualizer/public/data',
+                 tf_value_encoding='float32'):
         self.base_path = base_path
+        self.tf_value_encoding = tf_value_encoding
         self.binary_path = os.path.join(base_path, 'binary')
+        self.base_dir = os.path.join(self.binary_path, 'base')
+        self.tfs_dir = os.path.join(self.binary_path, 'tfs')
         
     def convert_all_base_data(self):
         """转换所有基础数据"""
         print("转换基础数据...")
         
         # 确保目录存在
-        os.makedirs(os.path.join(self.binary_path, 'base'), exist_ok=True)
-        os.makedirs(os.path.join(self.binary_path, 'tfs'), exist_ok=True)
+        os.makedirs(self.base_dir, exist_ok=True)
+        os.makedirs(self.tfs_dir, exist_ok=True)
         
         # 转换基础CSV文件
-        cell_id_to_index = self._convert_base_csv_data()
+        cell_id_dtype = self._convert_base_csv_data()
         
         # 转换TF活性数据（如果有）
-        tf_metadata = self._convert_tf_activity(cell_id_to_index)
+        tf_metadata = self._convert_tf_activity(cell_id_dtype, value_encoding=self.tf_value_encoding)
         
         # 创建完整元数据
-        self._create_complete_metadata(tf_metadata, len(cell_id_to_index))
+        self._create_complete_metadata(tf_metadata, len(cell_id_dtype.categories))
         
         print("基础数据转换完成！")
     
@@ -34,72 +89,111 @@ class BaseDataConverter:
         print("读取基础CSV文件...")
         
         # 读取基础CSV文件
-        coordinates = pd.read_csv(os.path.join(self.base_path, 'coordinates.csv'))
-        sections = pd.read_csv(os.path.join(self.base_path, 'section.csv'))
-        celltypes = pd.read_csv(os.path.join(self.base_path, 'celltype.csv'))
+        coordinates = self._read_csv_table('coordinates.csv')
+        sections = self._read_csv_table('section.csv')
+        celltypes = self._read_csv_table('celltype.csv')
         
         # 打印列名以便调试
-        print(f"坐标文件列名: {coordinates.columns.tolist()}")
-        print(f"切片文件列名: {sections.columns.tolist()}")
-        print(f"细胞类型文件列名: {celltypes.columns.tolist()}")
+        print(f"坐标文件列名: {coordinates.column_names}")
+        print(f"切片文件列名: {sections.column_names}")
+        print(f"细胞类型文件列名: {celltypes.column_names}")
         
-        # 获取第一列的名称（细胞ID列）
-        coord_first_col = coordinates.columns[0]
-        section_first_col = sections.columns[0]
-        celltype_first_col = celltypes.columns[0]
-        
-        # 获取第二列的名称（数据列）
-        section_second_col = sections.columns[1]
-        celltype_second_col = celltypes.columns[1]
-        
-        # 创建细胞ID映射
-        cell_ids = coordinates[coord_first_col].values
-        cell_id_to_index = {str(cell_id): idx for idx, cell_id in enumerate(cell_ids)}
+        # 创建细胞ID映射（第一列为细胞ID列），以分类类型的编号作为细胞索引
+        cell_ids = self._column_to_numpy(coordinates, 0, as_str=True)
+        cell_id_index = pd.Index(cell_ids)
+        if not cell_id_index.is_unique:
+            duplicates = cell_id_index[cell_id_index.duplicated()].unique().tolist()
+            raise ValueError(f"coordinates.csv 中存在 {len(duplicates)} 个重复的细胞ID，例如: {duplicates[:10]}")
+        cell_id_dtype = pd.CategoricalDtype(categories=cell_id_index)
         
         print(f"找到 {len(cell_ids)} 个细胞")
         
-        # 保存细胞ID
-        with open(os.path.join(self.binary_path, 'base', 'cell_ids.bin'), 'wb') as f:
-            f.write(struct.pack('I', len(cell_ids)))
-            for cell_id in cell_ids:
-                cell_bytes = str(cell_id).encode('utf-8')
-                f.write(struct.pack('I', len(cell_bytes)))
-                f.write(cell_bytes)
+        # 保存细胞ID：偏移数组 + 连续UTF-8数据（Arrow字符串布局）
+        encoded = np.char.encode(cell_ids.astype(str), 'utf-8')
+        offsets = np.zeros(len(cell_ids) + 1, dtype=np.uint32)
+        np.cumsum(np.char.str_len(encoded).astype(np.uint32), out=offsets[1:])
+        blob = b''.join(encoded.tolist())
+        if len(blob) >= 1 << 32:
+            raise ValueError(f"细胞ID数据过大（{len(blob)} 字节），超出uint32偏移范围")
+        with open(os.path.join(self.base_dir, 'cell_ids.bin'), 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(struct.pack('II', len(cell_ids), len(blob)))
+            f.write(offsets.tobytes())
+            f.write(blob)
         
         # 保存坐标数据
-        if 'x' in coordinates.columns and 'y' in coordinates.columns:
-            coords = coordinates[['x', 'y']].values.astype(np.float32)
+        if 'x' in coordinates.column_names and 'y' in coordinates.column_names:
+            coord_cols = [coordinates.column_names.index('x'), coordinates.column_names.index('y')]
         else:
-            coords = coordinates.iloc[:, 1:3].values.astype(np.float32)
+            coord_cols = [1, 2]
+        coords = np.column_stack([self._column_to_numpy(coordinates, i) for i in coord_cols]).astype(np.float32)
             
-        with open(os.path.join(self.binary_path, 'base', 'coordinates.bin'), 'wb') as f:
+        with open(os.path.join(self.base_dir, 'coordinates.bin'), 'wb', buffering=WRITE_BUFFER_SIZE) as f:
             f.write(struct.pack('I', coords.shape[0]))
             f.write(coords.tobytes())
         
+        # 按细胞ID映射切片与细胞类型（保持object类型，避免定长字符串截断）
+        ids_str = pd.Series(cell_ids)
+        
         # 保存切片数据
-        section_map = {str(row[section_first_col]): row[section_second_col] for _, row in sections.iterrows()}
-        section_data = np.array([section_map.get(str(cell_id), '') for cell_id in cell_ids], dtype='U10')
-        with open(os.path.join(self.binary_path, 'base', 'sections.bin'), 'wb') as f:
-            f.write(struct.pack('I', len(section_data)))
-            for section in section_data:
-                section_bytes = section.encode('utf-8')
-                f.write(struct.pack('I', len(section_bytes)))
-                f.write(section_bytes)
+        section_map = dict(zip(self._column_to_numpy(sections, 0, as_str=True), self._column_to_numpy(sections, 1)))
+        section_data = ids_str.map(section_map).fillna('').astype(str).to_numpy(dtype=object)
+        self._write_categorical(os.path.join(self.base_dir, 'sections.bin'), section_data)
         
         # 保存细胞类型数据
-        celltype_map = {str(row[celltype_first_col]): row[celltype_second_col] for _, row in celltypes.iterrows()}
-        celltype_data = np.array([celltype_map.get(str(cell_id), '') for cell_id in cell_ids], dtype='U50')
-        with open(os.path.join(self.binary_path, 'base', 'celltypes.bin'), 'wb') as f:
-            f.write(struct.pack('I', len(celltype_data)))
-            for celltype in celltype_data:
-                celltype_bytes = celltype.encode('utf-8')
-                f.write(struct.pack('I', len(celltype_bytes)))
-                f.write(celltype_bytes)
-        
-        return cell_id_to_index
+        celltype_map = dict(zip(self._column_to_numpy(celltypes, 0, as_str=True), self._column_to_numpy(celltypes, 1)))
+        celltype_data = ids_str.map(celltype_map).fillna('').astype(str).to_numpy(dtype=object)
+        self._write_categorical(os.path.join(self.base_dir, 'celltypes.bin'), celltype_data)
+        
+        return cell_id_dtype
     
-    def _convert_tf_activity(self, cell_id_to_index, chunk_size=1000):
-        """转换TF活性数据"""
+    def _write_categorical(self, path, values):
+        """以字典编码保存字符串列：类别表 + 每个细胞的类别编号"""
+        cat = pd.Categorical(values)
+        categories = [str(c) for c in cat.categories]
+        if len(categories) <= 1 << 8:
+            code_dtype = np.uint8
+        elif len(categories) <= 1 << 16:
+            code_dtype = np.uint16
+        else:
+            code_dtype = np.uint32
+        codes = cat.codes.astype(code_dtype)
+        
+        with open(path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            # 头部：细胞数、类别数、编号字节数
+            f.write(struct.pack('III', len(codes), len(categories), codes.itemsize))
+            for category in categories:
+                category_bytes = category.encode('utf-8')
+                f.write(struct.pack('I', len(category_bytes)))
+                f.write(category_bytes)
+            # 对齐到4字节，便于前端直接构建TypedArray
+            f.write(b'\0' * (-f.tell() % 4))
+            f.write(codes.tobytes())
+    
+    def _read_csv_header(self, path):
+        """读取CSV文件的列名（与PyArrow一致，去除UTF-8 BOM）"""
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            return next(csv.reader(f))
+    
+    def _read_csv_table(self, filename):
+        """使用PyArrow多线程读取CSV文件，第一列（细胞ID）按字符串读取"""
+        path = os.path.join(self.base_path, filename)
+        read_options = pacsv.ReadOptions(block_size=1 << 25, use_threads=True)
+        convert_options = pacsv.ConvertOptions(column_types={self._read_csv_header(path)[0]: pa.string()})
+        return pacsv.read_csv(path, read_options=read_options, convert_options=convert_options)
+    
+    @staticmethod
+    def _column_to_numpy(table, i, as_str=False):
+        """将表中第i列转换为NumPy数组"""
+        column = table.column(i)
+        if as_str:
+            column = column.cast(pa.string())
+        return column.to_numpy(zero_copy_only=False)
+    
+    def _convert_tf_activity(self, cell_id_dtype, block_size=32 << 20, value_encoding='float32'):
+        """转换TF活性数据，value_encoding 可选 'float32'、'float16' 或 'uint8'（按特征仿射量化）"""
+        if value_encoding not in ('float32', 'float16', 'uint8'):
+            raise ValueError(f"不支持的TF数值编码: {value_encoding}")
+        
         tf_csv_path = os.path.join(self.base_path, 'tf_activity.csv')
         
         if not os.path.exists(tf_csv_path):
@@ -110,8 +204,8 @@ class BaseDataConverter:
         
         try:
             # 先读取第一行获取列名
-            first_row = pd.read_csv(tf_csv_path, nrows=1)
-            features = first_row.columns[1:].tolist()  # 排除第一列细胞ID
+            header = self._read_csv_header(tf_csv_path)
+            features = header[1:]  # 排除第一列细胞ID
             print(f"找到 {len(features)} 个TF")
         except Exception as e:
             print(f"读取TF活性CSV文件头失败: {e}")
@@ -120,46 +214,130 @@ class BaseDataConverter:
         metadata = {
             'total_features': len(features),
             'features_processed': 0,
-            'feature_list': features
+            'feature_list': features,
+            'value_encoding': value_encoding
         }
         
-        # 分批处理特征
-        for i in tqdm(range(0, len(features), chunk_size), desc="处理TF"):
-            chunk_features = features[i:i+chunk_size]
-            
-            try:
-                # 只读取需要的列
-                usecols = [first_row.columns[0]] + chunk_features
-                df_chunk = pd.read_csv(tf_csv_path, usecols=usecols)
-                
-                first_col = df_chunk.columns[0]
-                
-                for feature in chunk_features:
-                    # 提取该特征的非零值
-                    feature_data = []
-                    for _, row in df_chunk.iterrows():
-                        cell_id = str(row[first_col])
-                        value = row[feature]
-                        if pd.notna(value) and value != 0:
-                            cell_index = cell_id_to_index.get(cell_id)
-                            if cell_index is not None:
-                                feature_data.append((cell_index, float(value)))
+        first_col = header[0]
+        batch_results = []
+        
+        # 单次流式读取CSV：PyArrow多线程分块解析，边读盘边解码
+        # 空字段及NA/NaN等标记解析为null，转为NumPy时成为float32的NaN
+        column_types = {feature: pa.float32() for feature in features}
+        column_types[first_col] = pa.string()
+        # PyArrow的解析/类型转换错误在读取数据块时抛出，读取失败时保留已读取的数据块
+        complete = True
+        try:
+            reader = pacsv.open_csv(
+                tf_csv_path,
+                read_options=pacsv.ReadOptions(block_size=block_size, use_threads=True),
+                convert_options=pacsv.ConvertOptions(column_types=column_types)
+            )
+            for i, batch in enumerate(tqdm(reader, desc="读取TF")):
+                try:
+                    # 一次性映射细胞ID，未找到的细胞（-1）丢弃
+                    rows = pd.Categorical(batch.column(0).to_numpy(zero_copy_only=False), dtype=cell_id_dtype).codes
+                    found = rows >= 0
+                    ids = rows[found].astype(np.uint32)
+                    
+                    # 按列写入列优先矩阵，null以NaN写入，由提取内核统一过滤
+                    values = np.empty((ids.size, len(features)), dtype=np.float32, order='F')
+                    for j in range(len(features)):
+                        values[:, j] = batch.column(j + 1).to_numpy(zero_copy_only=False)[found]
                     
-                    if feature_data:
-                        # 保存为二进制格式
-                        file_path = os.path.join(self.binary_path, 'tfs', f'{feature}.bin')
-                        with open(file_path, 'wb') as f:
-                            f.write(struct.pack('I', len(feature_data)))
-                            for cell_index, value in feature_data:
-                                f.write(struct.pack('If', cell_index, value))
-                
-                metadata['features_processed'] += len(chunk_features)
-            except Exception as e:
-                print(f"处理TF块 {i}-{i+chunk_size} 失败: {e}")
-                continue
+                    # 逐块提取非零值，只保留稀疏结果，避免同时持有整个稠密矩阵
+                    batch_results.append(_extract_nonzero(values, ids))
+                except Exception as e:
+                    print(f"处理TF数据块 {i} 失败: {e}")
+                    complete = False
+                    continue
+        except Exception as e:
+            print(f"读取TF活性CSV失败，仅保存已读取的 {len(batch_results)} 个数据块: {e}")
+            complete = False
+        
+        # 按特征合并各数据块的结果：特征j的记录按数据块顺序连续存放
+        counts = np.zeros(len(features), dtype=np.int64)
+        for _, _, batch_offsets in batch_results:
+            counts += np.diff(batch_offsets)
+        offsets = np.zeros(len(features) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        all_idx = np.empty(offsets[-1], dtype=np.uint32)
+        all_val = np.empty(offsets[-1], dtype=np.float32)
+        cursor = offsets[:-1].copy()
+        while batch_results:
+            idx, val, batch_offsets = batch_results.pop(0)
+            _merge_batch(all_idx, all_val, cursor, idx, val, batch_offsets)
+        offsets = offsets.astype(np.uint64)
+        
+        # 有数据块被跳过时，所有特征的数据都不完整
+        metadata['features_processed'] = len(features) if complete else 0
+        metadata['complete'] = complete
+        if not complete:
+            print("警告: TF活性数据不完整，已在metadata.json中标记 tfs.complete = false")
+        
+        all_idx, all_val, offsets, quantization = self._encode_tf_values(all_idx, all_val, offsets, value_encoding)
+        if quantization is not None:
+            metadata['quantization'] = quantization
+        
+        # 合并为单个Tiled-CSL容器：offsets[F+1] + 所有特征的cell_idx数组 + 所有特征的value数组（SoA）
+        with open(os.path.join(self.tfs_dir, 'tfs_offsets.bin'), 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(offsets.tobytes())
+        self._write_tf_container(os.path.join(self.tfs_dir, 'tfs.bin'), all_idx, all_val)
+        
+        metadata['offsets'] = offsets.tolist()
         
         return metadata
     
+    def _write_tf_container(self, path, all_idx, all_val):
+        """预分配容器文件并通过内存映射整段写入cell_idx与value数组"""
+        nnz = all_idx.size
+        value_dtype = all_val.dtype.newbyteorder('<')
+        with open(path, 'wb') as f:
+            f.truncate(nnz * (4 + value_dtype.itemsize))
+        if not nnz:
+            return
+        
+        idx_view = np.memmap(path, dtype='<u4', mode='r+', shape=(nnz,))
+        idx_view[:] = all_idx
+        idx_view.flush()
+        val_view = np.memmap(path, dtype=value_dtype, mode='r+', offset=4 * nnz, shape=(nnz,))
+        val_view[:] = all_val
+        val_view.flush()
+        del idx_view, val_view
+    
+    def _encode_tf_values(self, idx, values, offsets, value_encoding):
+        """按指定编码转换TF数值，uint8编码时返回每个特征的反量化参数"""
+        if value_encoding == 'float32':
+            return idx, values, offsets, None
+        
+        if value_encoding == 'float16':
+            if values.size and np.abs(values).max() > np.finfo(np.float16).max:
+                raise ValueError("TF活性值超出float16范围，请使用 value_encoding='float32'")
+            encoded = values.astype(np.float16)
+            
+            # 转换后下溢为0的记录不再是非零值，需从稀疏数据中移除
+            keep = encoded != 0
+            if not keep.all():
+                feature_ids = np.repeat(np.arange(offsets.size - 1), np.diff(offsets).astype(np.int64))
+                counts = np.bincount(feature_ids[keep], minlength=offsets.size - 1)
+                offsets = np.zeros(offsets.size, dtype=np.uint64)
+                np.cumsum(counts.astype(np.uint64), out=offsets[1:])
+                idx, encoded = idx[keep], encoded[keep]
+            return idx, encoded, offsets, None
+        
+        # 仿射量化：value ≈ min + q * scale
+        encoded = np.empty(values.size, dtype=np.uint8)
+        mins, scales = [], []
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            val = values[start:end]
+            vmin = float(val.min()) if val.size else 0.0
+            scale = (float(val.max()) - vmin) / 255.0 if val.size else 0.0
+            scale = scale or 1.0
+            encoded[start:end] = np.round((val - vmin) / scale)
+            mins.append(vmin)
+            scales.append(scale)
+        return idx, encoded, offsets, {'mins': mins, 'scales': scales}
+    
     def _create_complete_metadata(self, tf_metadata, total_cells):
         """创建完整的元数据文件"""
         # 读取基因元数据
@@ -175,25 +353,44 @@ class BaseDataConverter:
             print("警告: 未找到基因元数据，请先在Jupyter中运行基因转换")
         
         metadata = {
-            'version': '1.0',
+            'version': '2.0',
             'format': 'sparse_binary',
             'total_cells': total_cells,
+            'base': {
+                'cell_ids': {'file': 'base/cell_ids.bin', 'layout': 'utf8_offsets'},
+                'coordinates': {'file': 'base/coordinates.bin', 'layout': 'float32_xy'},
+                'sections': {'file': 'base/sections.bin', 'layout': 'dictionary'},
+                'celltypes': {'file': 'base/celltypes.bin', 'layout': 'dictionary'}
+            },
             'genes': {
                 'total': gene_metadata['total_features'],
                 'features': gene_metadata['feature_list']
             },
             'tfs': {
                 'total': tf_metadata['total_features'],
-                'features': tf_metadata['feature_list']
+                'features': tf_metadata['feature_list'],
+                'features_processed': tf_metadata['features_processed'],
+                'complete': tf_metadata.get('complete', True),
+                'layout': 'tiled_csl_soa',
+                'data_file': 'tfs/tfs.bin',
+                'offsets_file': 'tfs/tfs_offsets.bin',
+                'offsets': tf_metadata.get('offsets', [0]),
+                'value_encoding': tf_metadata.get('value_encoding', 'float32'),
+                'quantization': tf_metadata.get('quantization')
             },
-            'last_updated': pd.Timestamp.now().isoformat()
+            'last_updated': datetime.now(timezone.utc).isoformat()
         }
         
-        with open(os.path.join(self.binary_path, 'metadata.json'), 'w') as f:
-            json.dump(metadata, f, indent=2)
+        with open(os.path.join(self.binary_path, 'metadata.json'), 'wb') as f:
+            f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2))
 
 def main():
-    converter = BaseDataConverter()
+    parser = argparse.ArgumentParser(description='将CSV数据转换为前端使用的二进制格式')
+    parser.add_argument('--tf-value-encoding', choices=['float32', 'float16', 'uint8'], default='float32',
+                        help='TF活性值的存储编码：float16减半体积，uint8按特征仿射量化')
+    args = parser.parse_args()
+    
+    converter = BaseDataConverter(tf_value_encoding=args.tf_value_encoding)
     converter.convert_all_base_data()
 
 if __name__ == '__main__':